@@ -1,19 +1,54 @@
+from __future__ import annotations
+
 import streamlit as st
 import sqlite3
 import json
+import tempfile
 import os
+import asyncio
+import queue
+import time
+import hashlib
+import re
+import string
+import threading
+import logging
+from collections import OrderedDict, deque
+from contextlib import suppress
 from datetime import datetime
+from typing import TYPE_CHECKING
+
+from pydantic import BaseModel, Field
 
-# LangChain and OpenAI imports
-from langchain.agents import Tool, initialize_agent, AgentType, create_sql_agent
-from langchain.chat_models import ChatOpenAI
-from langchain_community.utilities.sql_database import SQLDatabase
-from langchain.prompts import PromptTemplate
+# LangChain, OpenAI, numpy and SQLAlchemy take seconds to import, so they are imported
+# where first used (and warmed up in the background after first paint) to keep cold start fast
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+    from openai import AsyncOpenAI
+    from sqlalchemy.engine import Engine
 
 # Suppress warnings
 import warnings
 warnings.filterwarnings('ignore')
 
+logger = logging.getLogger(__name__)
+
+# Static page markup. Not wrapped in st.cache_resource: Streamlit replays a cached function's elements on
+# every run, so that would send the same bytes. It is emitted on full reruns only, because a chat turn
+# reruns just the chat_panel fragment, which never escalates to an app rerun
+_STATIC_CSS = '''
+    <style>
+    .main { background-color: #f5f5f5; }
+    .stTextInput>div>div>input { background-color: white; }
+    </style>
+'''
+
+_FOOTER_HTML = '''
+    <div style='text-align: center'>
+        <p>🍔 FoodHub Chatbot | Powered by GPT-4o Mini & LangChain</p>
+    </div>
+'''
+
 # Page configuration
 st.set_page_config(
     page_title="FoodHub Customer Service Chatbot",
@@ -23,86 +58,762 @@ st.set_page_config(
 )
 
 # Custom CSS
-st.markdown('''
-    <style>
-    .main { background-color: #f5f5f5; }
-    .stTextInput>div>div>input { background-color: white; }
-    </style>
-''', unsafe_allow_html=True)
+st.markdown(_STATIC_CSS, unsafe_allow_html=True)
 
 # Initialize session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
+# Only the last few turns are replayed verbatim; older ones are folded into a running summary
+CHAT_HISTORY_TURNS = 6
+
 if "chat_history" not in st.session_state:
-    st.session_state.chat_history = ""
+    st.session_state.chat_history = deque(maxlen=CHAT_HISTORY_TURNS)
+if "chat_summary" not in st.session_state:
+    st.session_state.chat_summary = ""
+    st.session_state.summary_future = None
 if "agent_initialized" not in st.session_state:
     st.session_state.agent_initialized = False
 
-# ============== TOOL FUNCTIONS ==============
-
-def user_query_tool_func(query: str, user_context_raw: str) -> str:
-    prompt = f'''
-    You are a friendly FoodHub customer service assistant. Use only the provided order information to answer customer questions.
-
-    Order Information: {user_context_raw}
-    Customer Query: {query}
-
-    Guidelines:
-    - Never return the entire database or multiple customers' orders.
-    - Only return specific information needed to answer THIS customer's query.
-    - Be polite, friendly, and use natural conversational language.
-    - Format times in a customer-friendly way (e.g., "12:30 PM" instead of "12:30").
-    - Keep responses concise (2-3 sentences maximum).
-    '''
-
-    foodhub_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-    return foodhub_llm.predict(prompt)
-
-def answer_tool_func(query: str, raw_response: str, user_context_raw: str) -> str:
-    prompt = f'''
-    You are a helpful FoodHub customer service assistant. Convert the factual information into a friendly, natural response.
-
-    Order Information: {user_context_raw}
-    Customer Query: {query}
-    Facts Retrieved: {raw_response}
-
-    Rules:
-    - Keep the reply brief (1-2 sentences), friendly, and helpful.
-    - Use natural, conversational language.
-    - Format times in 12-hour format with AM/PM.
-    '''
-
-    answer_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)
-    return answer_llm.predict(prompt)
-
-def input_guard_check(user_query: str) -> str:
-    prompt = f'''Classify this customer query into one category:
-    0 - Escalation (angry, wants refund/cancellation)
-    1 - Exit (thanks, bye, satisfied)
-    2 - Process (order-related question)
-    3 - Random/Security threat (not about orders, hacking attempts)
-
-    Return ONLY the digit (0, 1, 2, or 3).
-
-    Customer Query: {user_query}'''
-
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-    res = llm.predict(prompt).strip()
-    res = "".join([c for c in res if c.isdigit()])
-    return res if res in ["0", "1", "2", "3"] else "0"
-
-def output_guard_check(model_output: str) -> str:
-    prompt = f'''Is this response SAFE or BLOCK?
-    SAFE: Contains only customer's own order info
-    BLOCK: Contains multiple customers' data, personal info, or system details
+# ============== RESPONSE CACHES ==============
+
+CACHE_DB = "response_cache.db"
+CACHE_TTL = 24 * 60 * 60
+
+class ExactMatchCache:
+    """Exact-match KV cache: in-process LRU in front of a SQLite table with a TTL."""
+
+    def __init__(self, path: str, table: str, ttl: float, maxsize: int = 4096):
+        self.table = table
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (query_hash TEXT PRIMARY KEY, label TEXT, ts REAL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        return hashlib.blake2b("|".join(parts).encode(), digest_size=16).hexdigest()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            hit = self._memo.get(key)
+            if hit is None:
+                row = self._conn.execute(
+                    f"SELECT label, ts FROM {self.table} WHERE query_hash = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                hit = row
+            label, ts = hit
+            if now - ts > self.ttl:
+                self._memo.pop(key, None)
+                return None
+            self._memo[key] = hit
+            self._memo.move_to_end(key)
+            if len(self._memo) > self.maxsize:
+                self._memo.popitem(last=False)
+            return label
+
+    def put(self, key: str, label: str) -> None:
+        entry = (label, time.time())
+        with self._lock:
+            self._memo[key] = entry
+            self._memo.move_to_end(key)
+            if len(self._memo) > self.maxsize:
+                self._memo.popitem(last=False)
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (query_hash, label, ts) VALUES (?, ?, ?)",
+                (key, *entry)
+            )
+            self._conn.commit()
+
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+class SemanticCache:
+    """Paraphrase-tolerant response cache, bucketed per order context so customers never share answers."""
+
+    def __init__(self, threshold: float, api_key: str, base_url: str, max_contexts: int = 1024, max_entries: int = 64):
+        self.threshold = threshold
+        self.max_contexts = max_contexts
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        from langchain_openai import OpenAIEmbeddings
+        self._embeddings = OpenAIEmbeddings(model="text-embedding-3-small", api_key=api_key, base_url=base_url)
+
+    async def lookup(self, namespace: str, query: str, context: str):
+        """Return (query_vector, cached_response or None); an embedding failure is treated as a miss."""
+        import numpy as np
+        try:
+            embedding = await self._embeddings.aembed_query(query)
+        except Exception as e:
+            logger.warning("Semantic cache lookup skipped: %s", e)
+            return None, None
+        vector = np.asarray(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector)
+        bucket_key = ExactMatchCache.key(namespace, context)
+        with self._lock:
+            entries = self._buckets.get(bucket_key)
+            if not entries:
+                return vector, None
+            self._buckets.move_to_end(bucket_key)
+            scores = np.stack([v for v, _ in entries]) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return vector, entries[best][1]
+        return vector, None
+
+    def store(self, namespace: str, context: str, vector, response) -> None:
+        if vector is None:
+            return
+        bucket_key = ExactMatchCache.key(namespace, context)
+        with self._lock:
+            entries = self._buckets.setdefault(bucket_key, [])
+            self._buckets.move_to_end(bucket_key)
+            entries.append((vector, response))
+            del entries[:-self.max_entries]
+            if len(self._buckets) > self.max_contexts:
+                self._buckets.popitem(last=False)
+
+# Shared across reruns and sessions; module globals are rebuilt on every Streamlit rerun
+@st.cache_resource
+def get_guard_cache() -> ExactMatchCache:
+    return ExactMatchCache(CACHE_DB, "guard_cache", CACHE_TTL)
+
+@st.cache_resource
+def get_sql_cache() -> ExactMatchCache:
+    return ExactMatchCache(CACHE_DB, "sql_cache", CACHE_TTL)
+
+@st.cache_resource
+def _cached_semantic_cache(api_key: str, base_url: str) -> SemanticCache:
+    return SemanticCache(SEMANTIC_CACHE_THRESHOLD, api_key, base_url)
+
+def get_semantic_cache() -> SemanticCache:
+    # Keyed on credentials like get_llm, so re-initializing never keeps embedding on the old key
+    return _cached_semantic_cache(os.environ.get("OPENAI_API_KEY"), os.environ.get("OPENAI_BASE_URL"))
+
+# Optional local guard classifier: a fine-tuned DistilBERT exported to ONNX
+# (optimum-cli export onnx --task text-classification), with labels "0"-"3"
+GUARD_MODEL_PATH = os.environ.get("FOODHUB_GUARD_MODEL")
+GUARD_MODEL_MIN_CONFIDENCE = 0.7
+
+@st.cache_resource
+def get_local_guard():
+    """Load the local classifier pipeline once, or return None when it isn't configured, installed or loadable."""
+    if not GUARD_MODEL_PATH:
+        return None
+    try:
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+        from transformers import AutoTokenizer, pipeline
+    except ImportError:
+        logger.warning("FOODHUB_GUARD_MODEL is set but optimum[onnxruntime] is not installed; using the LLM guard")
+        return None
+    try:
+        model = ORTModelForSequenceClassification.from_pretrained(GUARD_MODEL_PATH)
+        tokenizer = AutoTokenizer.from_pretrained(GUARD_MODEL_PATH)
+        return pipeline("text-classification", model=model, tokenizer=tokenizer)
+    except Exception:
+        # A bad model path shouldn't take the chat down; the LLM guard still covers every query
+        logger.exception("Could not load the local guard model from %s; using the LLM guard", GUARD_MODEL_PATH)
+        return None
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+@st.cache_resource
+def get_inflight_calls() -> dict:
+    # Only touched from the shared event loop thread, so no lock is needed
+    return {}
+
+async def single_flight(flights: dict, key: str, make_coro):
+    """Coalesce identical concurrent calls: later callers await the first caller's result instead of repeating it.
+
+    The work is cancelled only once every caller waiting on it has been cancelled.
+    """
+    flight = flights.get(key)
+    if flight is None:
+        flight = flights[key] = _Flight(asyncio.ensure_future(make_coro()))
+        flight.task.add_done_callback(lambda _: flights.pop(key, None) if flights.get(key) is flight else None)
+
+    flight.waiters += 1
+    try:
+        return await asyncio.shield(flight.task)
+    finally:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            flight.task.cancel()
+
+# ============== SHARED CLIENTS ==============
+
+def _preload():
+    import numpy
+    import httpx
+    import openai
+    import langchain_openai
+    import langchain_core.messages
+    import sqlalchemy
+
+@st.cache_resource
+def start_preload() -> threading.Thread:
+    """Import the heavy modules on a background thread once per process."""
+    thread = threading.Thread(target=_preload, daemon=True)
+    thread.start()
+    return thread
+
+HTTP_MAX_KEEPALIVE = 20
+HTTP_KEEPALIVE_EXPIRY = 60
+
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """One long-lived loop for all turns, so pooled async connections outlive a single turn."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource
+def _cached_llm(model: str, temperature: float, api_key: str, base_url: str) -> ChatOpenAI:
+    import httpx
+    from langchain_openai import ChatOpenAI
+
+    limits = httpx.Limits(max_keepalive_connections=HTTP_MAX_KEEPALIVE, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+    return ChatOpenAI(
+        model=model,
+        temperature=temperature,
+        api_key=api_key,
+        base_url=base_url,
+        http_client=httpx.Client(limits=limits),
+        http_async_client=httpx.AsyncClient(limits=limits)
+    )
+
+def get_llm(model: str, temperature: float) -> ChatOpenAI:
+    # Credentials are part of the key so re-initializing with a new API key gets a fresh client
+    return _cached_llm(model, temperature, os.environ.get("OPENAI_API_KEY"), os.environ.get("OPENAI_BASE_URL"))
+
+@st.cache_resource
+def _cached_openai_client(api_key: str, base_url: str) -> AsyncOpenAI:
+    import httpx
+    from openai import AsyncOpenAI
+
+    limits = httpx.Limits(max_keepalive_connections=HTTP_MAX_KEEPALIVE, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=httpx.AsyncClient(limits=limits))
+
+def get_openai_client() -> AsyncOpenAI:
+    return _cached_openai_client(os.environ.get("OPENAI_API_KEY"), os.environ.get("OPENAI_BASE_URL"))
+
+class TurnResources:
+    """Shared clients and caches for one turn, resolved on the script thread.
+
+    The st.cache_resource getters need the script thread's ScriptRunContext, so coroutines on the
+    shared event loop receive this instead of calling them.
+    """
+
+    def __init__(self):
+        self.llm = get_llm("gpt-4o-mini", 0)
+        self.openai_client = get_openai_client()
+        self.guard_cache = get_guard_cache()
+        self.sql_cache = get_sql_cache()
+        self.semantic_cache = get_semantic_cache()
+        self.inflight = get_inflight_calls()
+        self.local_guard = get_local_guard()
+
+# ============== DATABASE ==============
+
+def _tune_sqlite_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA query_only=1")
+    cursor.close()
+
+def open_orders_db(path: str) -> Engine:
+    """Open an uploaded orders DB read-only on SQLAlchemy's default connection pool.
+
+    Queries run on worker threads; the pool hands each one its own connection for the duration of a query.
+    immutable=1 is only sound because save_upload never rewrites a file once it is in place.
+    """
+    from sqlalchemy import create_engine, event
+
+    engine = create_engine(f"sqlite:///file:{path}?mode=ro&immutable=1&uri=true")
+    event.listen(engine, "connect", _tune_sqlite_connection)
+    return engine
+
+def describe_tables(engine: Engine, sample_rows: int = 3) -> str:
+    """CREATE statements plus a few sample rows per table, for the lookup prompt."""
+    parts = []
+    with engine.connect() as conn:
+        tables = conn.exec_driver_sql(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        ).fetchall()
+        for name, ddl in tables:
+            result = conn.exec_driver_sql(f'SELECT * FROM "{name}" LIMIT {sample_rows}')
+            rows = "\n".join("\t".join(str(value) for value in row) for row in result)
+            header = "\t".join(result.keys())
+            parts.append(f"{ddl}\n\n/*\n{sample_rows} rows from {name} table:\n{header}\n{rows}\n*/")
+    return "\n\n".join(parts)
+
+UPLOAD_DIR = "uploaded_dbs"
+# Uploads nobody has re-uploaded for this long are deleted. A session still open on a deleted file keeps its
+# pooled connections, but any new one fails until the database is uploaded again.
+UPLOAD_MAX_AGE = 7 * 24 * 60 * 60
+
+def prune_uploads(max_age: float) -> None:
+    """Delete stored uploads, and temp files left by crashed copies, untouched for max_age seconds."""
+    cutoff = time.time() - max_age
+    for entry in os.scandir(UPLOAD_DIR):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            with suppress(OSError):
+                os.remove(entry.path)
+
+def save_upload(upload) -> tuple:
+    """Store an uploaded DB under its content hash and return (path, fingerprint).
+
+    Each distinct upload gets its own file, so a file never changes while other sessions have it open,
+    and cached lookups keyed on the fingerprint never outlive the data they came from.
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    prune_uploads(UPLOAD_MAX_AGE)
+    digest = hashlib.blake2b(digest_size=16)
+    f = tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, suffix=".tmp", delete=False)
+    try:
+        # Copy in 1 MiB chunks rather than materializing a second full copy via read(), hashing on the way
+        with f:
+            for chunk in iter(lambda: upload.read(1 << 20), b""):
+                digest.update(chunk)
+                f.write(chunk)
+        fingerprint = digest.hexdigest()
+
+        path = os.path.join(UPLOAD_DIR, f"{fingerprint}.db")
+        if os.path.exists(path):
+            # Already stored; refresh its age so pruning treats it as in use
+            os.utime(path)
+        else:
+            os.replace(f.name, path)
+    finally:
+        # Gone after a successful rename; otherwise a duplicate or a failed copy
+        with suppress(FileNotFoundError):
+            os.remove(f.name)
+    return path, fingerprint
+
+def run_query(engine: Engine, sql: str) -> list:
+    with engine.connect() as conn:
+        return [dict(row._mapping) for row in conn.exec_driver_sql(sql)]
+
+# ============== CANNED REPLIES ==============
+
+# Fixed replies are returned as-is and never go through the model, so they need no output guard
+ESCALATION_MSG = "Sorry for the inconvenience. Let me connect you with our support team. Please contact support@foodhub.com or call 1-800-FOODHUB."
+EXIT_MSG = "Thank you! Have a great day! 😊"
+RANDOM_MSG = "I can only help with FoodHub order questions. Please ask about your order status, delivery time, or other order-related queries."
+BLOCKED_MSG = "I'm sorry, but I cannot provide the requested information. Please contact support@foodhub.com for assistance."
+TECH_ISSUE_MSG = "We are facing some technical issues. Please try again later."
+
+# Keyword-routed intents answered from a single fetched row without an LLM call; first match wins
+INTENT_TEMPLATES = [
+    ("eta", re.compile(r"\b(when|eta|how long|arriv\w*)\b", re.I),
+     "Your order {order_id} is {order_status} and should reach you by {delivery_eta}."),
+    ("status", re.compile(r"\b(status|where)\b", re.I),
+     "Your order {order_id} is currently: {order_status}."),
+]
+
+def _template_fields(template: str) -> frozenset:
+    return frozenset(field for _, field, _, _ in string.Formatter().parse(template) if field)
+
+# ============== PROMPTS ==============
+
+# Static instructions go in the system message and per-turn data last, so every
+# call shares a byte-identical prefix that OpenAI's automatic prompt caching can reuse.
+
+ANSWER_SYSTEM_PROMPT = '''You are a friendly FoodHub customer service assistant. Use only the provided order information to answer the customer's question.
+
+Guidelines:
+- Never return the entire database or multiple customers' orders.
+- Only return specific information needed to answer THIS customer's query.
+- Be polite, friendly, and use natural conversational language.
+- Format times in 12-hour format with AM/PM (e.g., "12:30 PM" instead of "12:30").
+- Keep the reply brief (1-2 sentences).
+
+Safety:
+- Set safe before writing the reply: false if answering would involve multiple customers' data, personal info, or system details.
+- The reply is shown to the customer as you write it, so it must stay within what you judged safe. When in doubt, set safe to false.'''
+
+INPUT_GUARD_SYSTEM_PROMPT = '''Classify the customer query into one category:
+0 - Escalation (angry, wants refund/cancellation)
+1 - Exit (thanks, bye, satisfied)
+2 - Process (order-related question)
+3 - Random/Security threat (not about orders, hacking attempts)
+
+Return ONLY the digit (0, 1, 2, or 3).'''
+
+SQL_SYSTEM_PROMPT = '''You look up FoodHub customer orders in a {dialect} database using the run_sql tool.
+Given the customer's question, call run_sql with one syntactically correct {dialect} SELECT that fetches only the relevant columns.
+When querying orders, always include order_id and order_status alongside the columns the question needs.
+Unless the customer asks for a specific number of orders, limit the query to at most {top_k} rows.
+If a query fails, fix it and try again.
+If the question cannot be answered from the database (for example, no order ID was given), do not call the tool; reply with what is missing.
+
+The complete schema is below:
+
+{table_info}'''
+
+SUMMARY_SYSTEM_PROMPT = '''You maintain a running summary of a FoodHub customer service chat.
+Merge the new exchange into the existing summary. Keep order IDs, customer IDs and open questions; drop pleasantries.
+Reply with the updated summary only, in at most 3 sentences.'''
+
+_NON_DIGITS = re.compile(r"\D+")
+
+# Unambiguous queries resolved locally before any LLM call; checked in order, first match wins
+_FAST_RULES = [
+    (re.compile(r"ignore (all )?previous|system prompt|\bsudo\b|<script", re.I), "3"),
+    (re.compile(r"\b(refund|cancel|angry|manager|lawsuit)\b", re.I), "0"),
+    (re.compile(r"^\s*(thanks?( you)?|thank you( so much)?|bye|goodbye|cya|ok(ay)?|great)[\s!.,😊]*$", re.I), "1"),
+]
 
-    Response: {model_output}
+# ============== TOOL FUNCTIONS ==============
 
-    Return only 'SAFE' or 'BLOCK'.'''
+SQL_MAX_ITERATIONS = 3
+
+RUN_SQL_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "run_sql",
+        "description": "Run a read-only SQL SELECT against the orders database and return the matching rows.",
+        "parameters": {
+            "type": "object",
+            "properties": {"query": {"type": "string", "description": "A single SQLite SELECT statement"}},
+            "required": ["query"]
+        }
+    }
+}
+
+async def retrieve_order_context(question: str, orders_db: Engine, table_info: str, client: AsyncOpenAI) -> tuple:
+    """Hand-rolled tool-calling loop on the raw OpenAI client.
+
+    Returns (context, rows): the fetched rows serialized as the order context, plus the rows
+    themselves as dicts (None when the model answered without querying or every query failed).
+    """
+    messages = [
+        {"role": "system", "content": SQL_SYSTEM_PROMPT.format(dialect="SQLite", top_k=10, table_info=table_info)},
+        {"role": "user", "content": question}
+    ]
+
+    context = ""
+    for _ in range(SQL_MAX_ITERATIONS):
+        completion = await client.chat.completions.create(
+            model="gpt-4o-mini", temperature=0, messages=messages, tools=[RUN_SQL_TOOL]
+        )
+        message = completion.choices[0].message
+        if not message.tool_calls:
+            return message.content, None
+        messages.append({
+            "role": "assistant",
+            "content": message.content,
+            "tool_calls": [call.model_dump() for call in message.tool_calls]
+        })
 
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-    res = llm.predict(prompt).strip().upper()
-    return res if res in ["SAFE", "BLOCK"] else "BLOCK"
+        results, rows, failed = [], [], False
+        for call in message.tool_calls:
+            try:
+                # Off the loop thread, so one slow query doesn't stall every other session's turn
+                call_rows = await asyncio.to_thread(
+                    run_query, orders_db, json.loads(call.function.arguments)["query"]
+                )
+                rows.extend(call_rows)
+                result = json.dumps(call_rows)
+            except Exception as e:
+                result, failed = f"Error: {e}", True
+            results.append(result)
+            messages.append({"role": "tool", "tool_call_id": call.id, "content": result})
+
+        context = "\n".join(results)
+        # The rows are the context; no need for another round-trip asking the model to restate them
+        if not failed:
+            return context, rows
+    return context, None
+
+_ORDER_ID = re.compile(r"\bO\d+\b", re.I)
+_CUSTOMER_ID = re.compile(r"\bC\d+\b", re.I)
+_WORD = re.compile(r"[a-z']+")
+# Words that don't change which columns a lookup needs; anything else makes the question too specific to share
+_LOOKUP_FILLER = frozenset("""
+    a an the is are was will be my me i i'm im it its it's this that of for on to with please pls can could you
+    tell show check know let what what's whats hi hello hey thanks thank here am order orders id number customer
+    currently now yet so far right
+""".split())
+
+def order_lookup_key(query: str, db_fingerprint: str):
+    """Cache key for bare "<intent> <order ID>" questions; None if the query asks anything beyond that.
+
+    The key ignores the wording, so it is only safe when the rest of the question can't change
+    which columns the lookup fetches.
+    """
+    order_ids = {match.upper() for match in _ORDER_ID.findall(query)}
+    intent, pattern = next(((name, pattern) for name, pattern, _ in INTENT_TEMPLATES if pattern.search(query)), (None, None))
+    if len(order_ids) != 1 or intent is None:
+        return None
+    rest = pattern.sub(" ", _CUSTOMER_ID.sub(" ", _ORDER_ID.sub(" ", query))).lower()
+    if not set(_WORD.findall(rest)) <= _LOOKUP_FILLER:
+        return None
+    customer_ids = sorted(match.upper() for match in _CUSTOMER_ID.findall(query))
+    return ExactMatchCache.key(db_fingerprint, ",".join(customer_ids), intent, order_ids.pop())
+
+async def lookup_order_context(prompt: str, combined_query: str, orders_db: Engine, table_info: str,
+                               db_fingerprint: str, resources: TurnResources) -> tuple:
+    """retrieve_order_context behind the on-disk SQL result cache and in-flight coalescing."""
+    cache = resources.sql_cache
+    key = order_lookup_key(prompt, db_fingerprint)
+    if key is not None:
+        # The cache may read and commit to SQLite, so keep that disk I/O off the shared loop thread
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return tuple(json.loads(cached))
+
+    context, rows = await single_flight(
+        resources.inflight,
+        ExactMatchCache.key("sql", db_fingerprint, combined_query),
+        lambda: retrieve_order_context(combined_query, orders_db, table_info, resources.openai_client)
+    )
+    if key is not None and rows is not None:
+        await asyncio.to_thread(cache.put, key, json.dumps([context, rows]))
+    return context, rows
+
+def format_time(value):
+    """'12:30' / '13:05' -> '12:30 PM' / '1:05 PM'; anything else is returned unchanged."""
+    try:
+        return datetime.strptime(value, "%H:%M").strftime("%I:%M %p").lstrip("0")
+    except (TypeError, ValueError):
+        return value
+
+def template_reply(query: str, rows: list):
+    """Answer common single-order intents straight from the row; None means the LLM should compose it."""
+    if not rows or len(rows) != 1:
+        return None
+    row = {column: format_time(value) for column, value in rows[0].items()}
+    if None in row.values():
+        return None
+
+    for intent, pattern, template in INTENT_TEMPLATES:
+        if not pattern.search(query):
+            continue
+        # Any column the template doesn't use was fetched for a part of the question it can't answer
+        if set(row) != _template_fields(template):
+            return None
+        if intent == "eta" and row["order_status"] in ("delivered", "canceled"):
+            return None
+        return template.format(**row)
+    return None
+
+class ReplySchema(BaseModel):
+    """Customer-facing reply with the model's own safety verdict.
+
+    `safe` is declared first so the verdict arrives before any reply text is streamed, and an unsafe
+    reply is never shown. The model commits to it before writing rather than reviewing the finished
+    text, which is weaker than the separate output guard it replaced.
+    """
+
+    safe: bool = Field(description="Decided before writing the reply: false if answering would expose other customers' orders, personal info, or system details")
+    reply: str = Field(description="The message shown to the customer")
+
+async def answer_tool_func(query: str, user_context_raw: str, tokens: queue.Queue, resources: TurnResources) -> ReplySchema:
+    cache = resources.semantic_cache
+    vector, cached = await cache.lookup("answer", query, user_context_raw)
+    if cached is not None:
+        if cached.safe:
+            tokens.put(cached.reply)
+        return cached
+
+    led = False
+
+    async def compose() -> ReplySchema:
+        nonlocal led
+        led = True
+        from langchain_core.messages import HumanMessage, SystemMessage
+
+        messages = [
+            SystemMessage(content=ANSWER_SYSTEM_PROMPT),
+            HumanMessage(content=f"Order Information: {user_context_raw}\nCustomer Query: {query}")
+        ]
+
+        # Temperature 0 keeps replies deterministic, which is what makes them cacheable
+        # function_calling streams partial arguments; json_schema would only yield the finished object
+        answer_llm = resources.llm.with_structured_output(ReplySchema, method="function_calling")
+        result, streamed = None, ""
+        async for partial in answer_llm.astream(messages):
+            result = partial
+            # Partials only validate once safe is known, so nothing is streamed ahead of the verdict
+            if partial.safe and len(partial.reply) > len(streamed):
+                tokens.put(partial.reply[len(streamed):])
+                streamed = partial.reply
+
+        cache.store("answer", user_context_raw, vector, result)
+        return result
+
+    result = await single_flight(resources.inflight, ExactMatchCache.key("answer", query, user_context_raw), compose)
+    # Only the caller that ran compose() streamed; anyone who joined it gets the reply in one piece
+    if not led and result.safe:
+        tokens.put(result.reply)
+    return result
+
+def fast_rule_label(user_query: str):
+    """Guard label for queries _FAST_RULES settle without any network call, else None."""
+    for pattern, label in _FAST_RULES:
+        if pattern.search(user_query):
+            return label
+    return None
+
+async def input_guard_check(user_query: str, resources: TurnResources) -> str:
+    cache = resources.guard_cache
+    key = cache.key("input", user_query.strip().lower())
+    # The cache may read and commit to SQLite, so keep that disk I/O off the shared loop thread
+    cached = await asyncio.to_thread(cache.get, key)
+    if cached is not None:
+        return cached
+
+    # Confident local predictions skip the LLM; low-confidence ones fall through to it
+    local_guard = resources.local_guard
+    if local_guard is not None:
+        # Inference is CPU-bound, so keep it off the loop thread that every session's turn runs on
+        prediction = (await asyncio.to_thread(local_guard, user_query))[0]
+        label = _NON_DIGITS.sub("", prediction["label"])
+        if prediction["score"] >= GUARD_MODEL_MIN_CONFIDENCE and label in ["0", "1", "2", "3"]:
+            return label
+
+    from langchain_core.messages import HumanMessage, SystemMessage
+
+    messages = [
+        SystemMessage(content=INPUT_GUARD_SYSTEM_PROMPT),
+        HumanMessage(content=f"Customer Query: {user_query}")
+    ]
+
+    res = (await resources.llm.ainvoke(messages)).content.strip()
+    res = _NON_DIGITS.sub("", res)
+    if res not in ["0", "1", "2", "3"]:
+        return "0"
+    await asyncio.to_thread(cache.put, key, res)
+    return res
+
+# ============== CHAT PIPELINE ==============
+
+async def summarize_history(llm: ChatOpenAI, previous, summary: str, turn: tuple) -> str:
+    """Fold an evicted (user, assistant) turn into the summary; `previous` is a still-pending summary future, if any."""
+    if previous is not None:
+        try:
+            summary = await asyncio.wrap_future(previous)
+        except Exception:
+            pass
+
+    from langchain_core.messages import HumanMessage, SystemMessage
+
+    messages = [
+        SystemMessage(content=SUMMARY_SYSTEM_PROMPT),
+        HumanMessage(content=f"Summary: {summary}\nuser: {turn[0]}\tassistant: {turn[1]}")
+    ]
+    return (await llm.ainvoke(messages)).content.strip()
+
+def current_summary() -> str:
+    future = st.session_state.summary_future
+    if future is not None and future.done():
+        if future.exception() is None:
+            st.session_state.chat_summary = future.result()
+        st.session_state.summary_future = None
+    return st.session_state.chat_summary
+
+def remember_turn(prompt: str, response: str) -> None:
+    history = st.session_state.chat_history
+    if len(history) == history.maxlen:
+        # Summarize the turn about to be evicted in the background; the next turn picks it up if ready
+        st.session_state.summary_future = asyncio.run_coroutine_threadsafe(
+            summarize_history(get_llm("gpt-4o-mini", 0), st.session_state.summary_future, current_summary(), history[0]),
+            get_event_loop()
+        )
+    history.append((prompt, response))
+
+def format_history() -> str:
+    summary = current_summary()
+    lines = [f"Summary: {summary}"] if summary else []
+    lines += [f"user: {user}\tassistant: {assistant}" for user, assistant in st.session_state.chat_history]
+    return "\n".join(lines)
+
+def discard_task(task: asyncio.Task) -> None:
+    """Cancel a task whose result is no longer wanted, without leaving an unretrieved exception behind."""
+    task.cancel()
+    # If it already finished with an error, cancel() is a no-op; retrieving the error stops asyncio logging it
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+async def handle_turn(prompt: str, chat_history: str, orders_db: Engine, table_info: str, db_fingerprint: str,
+                      resources: TurnResources, tokens: queue.Queue):
+    """Run one chat turn, streaming the composed answer into `tokens`.
+
+    Returns (response, remember) where `remember` marks turns that belong in the chat history.
+    Runs off the Streamlit script thread, so it must not touch st.session_state.
+    """
+    combined_query = f"User query: {prompt}\nPrevious: {chat_history}" if chat_history else prompt
+
+    # Checked before anything is scheduled, so small talk never starts the speculative lookup
+    guard_result = fast_rule_label(prompt)
+    sql_task = None
+    if guard_result is None:
+        # Start the SQL lookup speculatively alongside the guard; its result is dropped unless the query is "Process"
+        guard_task = asyncio.create_task(input_guard_check(prompt, resources))
+        sql_task = asyncio.create_task(
+            lookup_order_context(prompt, combined_query, orders_db, table_info, db_fingerprint, resources)
+        )
+        try:
+            guard_result = await guard_task
+        finally:
+            # Also on a guard error, so the lookup never outlives the turn
+            if guard_result != "2":
+                discard_task(sql_task)
+
+    if guard_result == "0":
+        return ESCALATION_MSG, False
+    elif guard_result == "1":
+        return EXIT_MSG, False
+    elif guard_result == "3":
+        return RANDOM_MSG, False
+    elif guard_result == "2":
+        try:
+            user_context_raw, rows = await sql_task
+
+            templated = template_reply(prompt, rows)
+            if templated is not None:
+                tokens.put(templated)
+                return templated, True
+
+            answer = await answer_tool_func(prompt, user_context_raw, tokens, resources)
+
+            # An unsafe reply was never streamed; the canned refusal is shown in its place
+            if not answer.safe:
+                response = BLOCKED_MSG
+            else:
+                response = answer.reply
+
+            return response, True
+
+        except Exception as e:
+            return f"Sorry, I encountered an error: {str(e)}. Please try again or contact support.", False
+    else:
+        return TECH_ISSUE_MSG, False
+
+def stream_turn(prompt: str, chat_history: str, orders_db: Engine, table_info: str, db_fingerprint: str, result: dict):
+    """Yield answer tokens while handle_turn runs on the shared event loop; its return value lands in result["turn"]."""
+    tokens = queue.Queue()
+    # Runs on the script thread, so the cache_resource getters are resolved here rather than on the loop
+    resources = TurnResources()
+    future = asyncio.run_coroutine_threadsafe(
+        handle_turn(prompt, chat_history, orders_db, table_info, db_fingerprint, resources, tokens),
+        get_event_loop()
+    )
+    future.add_done_callback(lambda _: tokens.put(None))
+
+    while (token := tokens.get()) is not None:
+        yield token
+    result["turn"] = future.result()
 
 # ============== SIDEBAR ==============
 
@@ -122,21 +833,20 @@ with st.sidebar:
         elif not db_file:
             st.error("Please upload your database file!")
         else:
-            with open("temp_database.db", "wb") as f:
-                f.write(db_file.read())
+            db_path, db_fingerprint = save_upload(db_file)
 
             os.environ['OPENAI_API_KEY'] = openai_api_key
             os.environ['OPENAI_BASE_URL'] = openai_api_base
 
             try:
-                st.session_state.customer_orders_db = SQLDatabase.from_uri("sqlite:///temp_database.db")
-                st.session_state.llm = ChatOpenAI(model_name="gpt-4o-mini", temperature=0)
-                st.session_state.sqlite_agent = create_sql_agent(
-                    st.session_state.llm,
-                    db=st.session_state.customer_orders_db,
-                    agent_type="openai-tools",
-                    verbose=False
-                )
+                previous_db = st.session_state.get("customer_orders_db")
+                st.session_state.customer_orders_db = open_orders_db(db_path)
+                # Close the connections this session held on its previous upload
+                if previous_db is not None:
+                    previous_db.dispose()
+                # Introspect once here instead of on every lookup
+                st.session_state.table_info = describe_tables(st.session_state.customer_orders_db)
+                st.session_state.db_fingerprint = db_fingerprint
                 st.session_state.agent_initialized = True
                 st.success("✅ System initialized successfully!")
             except Exception as e:
@@ -146,89 +856,91 @@ with st.sidebar:
 
     if st.button("🗑️ Clear Chat History"):
         st.session_state.messages = []
-        st.session_state.chat_history = ""
+        st.session_state.chat_history.clear()
+        st.session_state.chat_summary = ""
+        st.session_state.summary_future = None
         st.rerun()
 
-    st.subheader("📊 Statistics")
-    st.metric("Total Messages", len(st.session_state.messages))
-
 # ============== MAIN INTERFACE ==============
 
 st.title("🍔 FoodHub Customer Service Chatbot")
 st.markdown("*Get instant help with your food delivery orders*")
 
-# Display messages
-for message in st.session_state.messages:
+# Older messages are only rendered on request, keeping per-rerun work constant in long sessions
+RECENT_MESSAGES_SHOWN = 20
+
+def render_message(message: dict) -> None:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
         if "timestamp" in message:
             st.caption(f"🕒 {message['timestamp']}")
 
-# Chat input
-if prompt := st.chat_input("Ask about your order..."):
-    if not st.session_state.agent_initialized:
-        st.warning("⚠️ Please initialize the system first using the sidebar!")
-    else:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        st.session_state.messages.append({
-            "role": "user",
-            "content": prompt,
-            "timestamp": timestamp
-        })
-
-        with st.chat_message("user"):
-            st.markdown(prompt)
-            st.caption(f"🕒 {timestamp}")
-
-        with st.chat_message("assistant"):
-            with st.spinner("Processing..."):
-                guard_result = input_guard_check(prompt)
-
-                if guard_result == "0":
-                    response = "Sorry for the inconvenience. Let me connect you with our support team. Please contact support@foodhub.com or call 1-800-FOODHUB."
-                elif guard_result == "1":
-                    response = "Thank you! Have a great day! 😊"
-                elif guard_result == "3":
-                    response = "I can only help with FoodHub order questions. Please ask about your order status, delivery time, or other order-related queries."
-                elif guard_result == "2":
-                    try:
-                        combined_query = f"User query: {prompt}\nPrevious: {st.session_state.chat_history}" if st.session_state.chat_history else prompt
-
-                        sql_response = st.session_state.sqlite_agent.invoke(combined_query)
-                        user_context_raw = sql_response['output']
-
-                        factual_response = user_query_tool_func(prompt, user_context_raw)
-                        raw_response = answer_tool_func(prompt, factual_response, user_context_raw)
-
-                        if output_guard_check(raw_response) == "BLOCK":
-                            response = "I'm sorry, but I cannot provide the requested information. Please contact support@foodhub.com for assistance."
-                        else:
-                            response = raw_response
-
-                        st.session_state.chat_history += f"\nuser: {prompt}\tassistant: {response}"
+# A fragment, so submitting a message reruns only the chat panel instead of the whole script
+@st.fragment
+def chat_panel():
+    # Lives in the fragment so it tracks chat turns; filled in last so it includes this turn's messages
+    message_count = st.empty()
+
+    # Display messages
+    older = st.session_state.messages[:-RECENT_MESSAGES_SHOWN]
+    if older and st.toggle(f"Show {len(older)} earlier messages", key="show_older_messages"):
+        for message in older:
+            render_message(message)
+    for message in st.session_state.messages[-RECENT_MESSAGES_SHOWN:]:
+        render_message(message)
+
+    # Chat input
+    if prompt := st.chat_input("Ask about your order..."):
+        if not st.session_state.agent_initialized:
+            st.warning("⚠️ Please initialize the system first using the sidebar!")
+        else:
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            st.session_state.messages.append({
+                "role": "user",
+                "content": prompt,
+                "timestamp": timestamp
+            })
+
+            with st.chat_message("user"):
+                st.markdown(prompt)
+                st.caption(f"🕒 {timestamp}")
+
+            with st.chat_message("assistant"):
+                result = {}
+                placeholder = st.empty()
+                streamed = placeholder.write_stream(
+                    stream_turn(
+                        prompt,
+                        format_history(),
+                        st.session_state.customer_orders_db,
+                        st.session_state.table_info,
+                        st.session_state.db_fingerprint,
+                        result
+                    )
+                )
 
-                    except Exception as e:
-                        response = f"Sorry, I encountered an error: {str(e)}. Please try again or contact support."
-                else:
-                    response = "We are facing some technical issues. Please try again later."
+                response, remember = result["turn"]
+                if response != streamed:
+                    placeholder.markdown(response)
+                if remember:
+                    remember_turn(prompt, response)
 
-                st.markdown(response)
                 response_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 st.caption(f"🕒 {response_time}")
 
-        st.session_state.messages.append({
-            "role": "assistant",
-            "content": response,
-            "timestamp": response_time
-        })
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": response,
+                "timestamp": response_time
+            })
+
+    message_count.metric("Total Messages", len(st.session_state.messages))
+
+chat_panel()
 
 # Footer
 st.markdown("---")
-st.markdown(
-    '''
-    <div style='text-align: center'>
-        <p>🍔 FoodHub Chatbot | Powered by GPT-4o Mini & LangChain</p>
-    </div>
-    ''',
-    unsafe_allow_html=True
-)
+st.markdown(_FOOTER_HTML, unsafe_allow_html=True)
+
+# Warm up lazy imports now that the page has been painted
+start_preload()